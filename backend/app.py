@@ -1,24 +1,68 @@
 # app.py - Final version with video_description, separate audio/visual chunks, LLaVA for frame descriptions,
 # and fixed yt-dlp download with binary
 
+from contextlib import asynccontextmanager, contextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import subprocess
-import whisper
+import asyncio
+from faster_whisper import WhisperModel
 import ollama
 import os
-from langchain_community.document_loaders import TextLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import psycopg2 as pg
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from pathlib import Path
 import json
+import hashlib
+import io
+import struct
+import weakref
+import threading
+from functools import lru_cache
+from itertools import chain, repeat
 import uvicorn
 import shutil
 import easyocr
-
-app = FastAPI()
-ocr_reader = easyocr.Reader(['en'], gpu=False)
+import torch
+import numpy as np
+import imagehash
+from PIL import Image
+
+# Models are loaded once per worker at startup and shared by all requests
+ocr_reader = None
+whisper_model = None
+
+@asynccontextmanager
+async def lifespan(app):
+    global ocr_reader, whisper_model
+    # EasyOCR runs on CUDA when present; quantize applies int8 dynamic quantization on CPU
+    ocr_reader = easyocr.Reader(['en'], gpu=torch.cuda.is_available(), quantize=True)
+    whisper_model = WhisperModel("base", device="auto", compute_type="int8")
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+EMBED_MODEL = 'nomic-embed-text'
+# Texts per /api/embed request; larger batches only pay off on CUDA
+EMBED_BATCH_SIZE = 128 if torch.cuda.is_available() else 32
+# Concurrent /api/embeddings requests when /api/embed is unavailable
+EMBED_FALLBACK_CONCURRENCY = 8
+# Whisper expects 16kHz mono float32 PCM
+WHISPER_SAMPLE_RATE = 16000
+# Frames per readtext_batched call: the CRAFT detector runs on the whole group in one
+# forward pass, so this is the detector batch and must stay small
+OCR_GROUP_SIZE = 4
+# EasyOCR's recognizer batch size
+OCR_BATCH_SIZE = 8
+# Frames taller than this are downscaled before batching to bound detector memory
+OCR_MAX_HEIGHT = 720
+# Frames whose perceptual hash differs from the previous kept frame by fewer bits are skipped
+FRAME_HASH_THRESHOLD = 5
+# Cached embeddings unused for this long are pruned
+EMBED_CACHE_TTL_DAYS = 30
 
 # Allow CORS for your frontend
 app.add_middleware(
@@ -37,9 +81,12 @@ try:
 except (FileNotFoundError, json.JSONDecodeError):
     config_data = {}
 
-# Database connection
+# Database connection pool, shared by concurrent requests
+DB_POOL_MAX = 16
 try:
-    conn = pg.connect(
+    db_pool = ThreadedConnectionPool(
+        minconn=2,
+        maxconn=DB_POOL_MAX,
         user=config_data.get('database', {}).get('user'),
         password=config_data.get('database', {}).get('password'),
         host=config_data.get('database', {}).get('host', 'localhost'),
@@ -50,6 +97,205 @@ except pg.OperationalError as e:
     print(f"Database connection error: {e}")
     raise
 
+# getconn() raises PoolError when the pool is exhausted, so callers queue here instead
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+@contextmanager
+def db_connection():
+    """Borrow a connection from the pool, waiting for one if all are in use, rolling back on error."""
+    with db_pool_slots:
+        conn = db_pool.getconn()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            db_pool.putconn(conn)
+
+# struct formats for the timestamp column types binary COPY knows how to send
+BINARY_TIMESTAMP_FORMATS = {
+    'smallint': '>h',
+    'integer': '>i',
+    'bigint': '>q',
+    'real': '>f',
+    'double precision': '>d',
+}
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+
+# Schema changes live in migrate.py; binary COPY has to encode timestamps in the column's exact type
+with db_connection() as conn, conn.cursor() as cur:
+    cur.execute("""
+        SELECT format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = 'video_chunks'::regclass AND attname = 'timestamp_start'
+    """)
+    timestamp_format = BINARY_TIMESTAMP_FORMATS.get(cur.fetchone()[0])
+
+# Hot-path queries, prepared server-side once per pooled connection: name -> (param types, SQL)
+PREPARED_STATEMENTS = {
+    'cache_lookup': ('text, text[]', """
+        UPDATE embedding_cache SET last_used = now()
+        WHERE model = $1 AND hash = ANY($2)
+        RETURNING hash, embedding::text
+    """),
+    # Top-k audio and top-k visual (OCR text) chunks in one round trip;
+    # each branch is an exact scan of one video's chunks via the (video_url, chunk_type) index
+    'chunk_search': ('text, halfvec, integer', """
+        (SELECT chunk_type, chunk_text, image_path
+         FROM video_chunks
+         WHERE video_url = $1 AND chunk_type = 'audio'
+         ORDER BY embedding <=> $2
+         LIMIT $3)
+        UNION ALL
+        (SELECT chunk_type, chunk_text, image_path
+         FROM video_chunks
+         WHERE video_url = $1 AND chunk_type = 'visual'
+         ORDER BY embedding <=> $2
+         LIMIT $3)
+    """),
+}
+prepared_names = weakref.WeakKeyDictionary()  # connection -> names prepared on it
+
+def execute_prepared(cur, name, params):
+    """Run one of PREPARED_STATEMENTS, preparing it first if this connection hasn't yet."""
+    prepared = prepared_names.setdefault(cur.connection, set())
+    if name not in prepared:
+        param_types, sql = PREPARED_STATEMENTS[name]
+        cur.execute(f"PREPARE {name} ({param_types}) AS {sql}")
+        prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+async def request_embeddings_concurrently(texts):
+    """Embed texts one per /api/embeddings call, keeping a few requests in flight."""
+    semaphore = asyncio.Semaphore(EMBED_FALLBACK_CONCURRENCY)
+
+    # The client is closed on exit, before asyncio.run() tears down the loop
+    async with ollama.AsyncClient() as client:
+        async def embed_one(text):
+            async with semaphore:
+                return (await client.embeddings(model=EMBED_MODEL, prompt=text))['embedding']
+
+        return await asyncio.gather(*(embed_one(text) for text in texts))
+
+def request_embeddings(texts):
+    """Embed a list of texts with as few Ollama round trips as possible."""
+    embeddings = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = texts[start:start + EMBED_BATCH_SIZE]
+        try:
+            batch_embs = ollama.embed(model=EMBED_MODEL, input=batch).get('embeddings')
+        except ollama.ResponseError:
+            batch_embs = None
+
+        # Older Ollama servers have no /api/embed; fall back to one call per text.
+        # Handlers run in worker threads, so there is no event loop here already.
+        if not batch_embs or len(batch_embs) != len(batch):
+            batch_embs = asyncio.run(request_embeddings_concurrently(batch))
+
+        embeddings.extend(batch_embs)
+    return embeddings
+
+def embed_texts(texts):
+    """Embed texts, only sending those missing from embedding_cache to Ollama."""
+    if not texts:
+        return []
+    hashes = [hashlib.sha256(text.encode()).hexdigest() for text in texts]
+
+    with db_connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'cache_lookup', (EMBED_MODEL, list(set(hashes))))
+        cached = {h: json.loads(emb) for h, emb in cur.fetchall()}
+        conn.commit()
+
+    # Deduplicate so repeated chunk text is only embedded once
+    missing = {h: text for h, text in zip(hashes, texts) if h not in cached}
+    if not missing:
+        return [cached[h] for h in hashes]
+
+    # Don't hold a pooled connection while Ollama is working
+    new_embs = request_embeddings(list(missing.values()))
+    cached.update(zip(missing.keys(), new_embs))
+
+    with db_connection() as conn, conn.cursor() as cur:
+        execute_values(cur, """
+            INSERT INTO embedding_cache (hash, model, embedding)
+            VALUES %s
+            ON CONFLICT (hash, model) DO NOTHING
+        """, [(h, EMBED_MODEL, json.dumps(emb)) for h, emb in zip(missing.keys(), new_embs)],
+            template="(%s, %s, %s::vector)")
+        conn.commit()
+
+    return [cached[h] for h in hashes]
+
+def prune_embedding_cache():
+    """Drop cached embeddings unused for EMBED_CACHE_TTL_DAYS; run once per ingest."""
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            DELETE FROM embedding_cache
+            WHERE last_used < now() - make_interval(days => %s)
+        """, (EMBED_CACHE_TTL_DAYS,))
+        conn.commit()
+
+@lru_cache(maxsize=1024)
+def embed_question(model, text):
+    """Embed a query, serialized for pgvector; repeated questions skip Ollama."""
+    return json.dumps(ollama.embeddings(model=model, prompt=text)['embedding'])
+
+def copy_value(value):
+    """Render one field in PostgreSQL's text COPY format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, list):
+        # JSON arrays match pgvector's text representation and json encodes in C
+        return json.dumps(value)
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+def binary_copy_row(row):
+    """Encode one video_chunks row as a PostgreSQL binary COPY tuple."""
+    video_url, video_description, chunk_type, chunk_text, embedding, image_path, start, end = row
+    fields = [
+        video_url.encode(), video_description.encode(), chunk_type.encode(), chunk_text.encode(),
+        # pgvector halfvec binary format: int16 dim, int16 unused, big-endian float16s
+        struct.pack('>hh', len(embedding), 0) + np.asarray(embedding, dtype='>f2').tobytes(),
+        None if image_path is None else image_path.encode(),
+        None if start is None else struct.pack(timestamp_format, start),
+        None if end is None else struct.pack(timestamp_format, end),
+    ]
+    parts = [struct.pack('>h', len(fields))]
+    for field in fields:
+        if field is None:
+            parts.append(struct.pack('>i', -1))
+        else:
+            parts.append(struct.pack('>i', len(field)))
+            parts.append(field)
+    return b''.join(parts)
+
+def copy_chunks(cur, rows):
+    """Bulk load video_chunks rows with a single COPY FROM STDIN."""
+    columns = "video_chunks (video_url, video_description, chunk_type, chunk_text, embedding, image_path, timestamp_start, timestamp_end)"
+
+    # Binary COPY sends embeddings as packed floats rather than decimal text
+    if timestamp_format is not None:
+        buf = io.BytesIO()
+        buf.write(BINARY_COPY_HEADER)
+        for row in rows:
+            buf.write(binary_copy_row(row))
+        buf.write(struct.pack('>h', -1))
+        buf.seek(0)
+        cur.copy_expert(f"COPY {columns} FROM STDIN WITH (FORMAT BINARY)", buf)
+        return
+
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(copy_value(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert(f"COPY {columns} FROM STDIN", buf)
+
 class VideoURL(BaseModel):
     url: str
     description: str = ""  # Optional user-provided description
@@ -59,10 +305,11 @@ class Query(BaseModel):
     video_url: str
     top_k: int = 8
 
+# Handlers are plain functions so FastAPI runs the blocking work in its threadpool
 @app.get("/list-videos")
-async def list_videos():
+def list_videos():
     try:
-        with conn.cursor() as cur:
+        with db_connection() as conn, conn.cursor() as cur:
             cur.execute("""
                 SELECT DISTINCT video_url, video_description 
                 FROM video_chunks 
@@ -74,7 +321,7 @@ async def list_videos():
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/ingest-video")
-async def ingest_video(data: VideoURL):
+def ingest_video(data: VideoURL):
     try:
         video_url = data.url.strip()
         if not video_url:
@@ -83,101 +330,113 @@ async def ingest_video(data: VideoURL):
         user_description = data.description.strip() or f"Video from {video_url.split('?')[0]}"
 
         video_id = video_url.split('v=')[-1] if 'youtube' in video_url else f"video_{os.urandom(4).hex()}"
-        mp4_path = f"{video_id}.mp4"
-        transcript_path = f"{video_id}_transcript.txt"
         frames_dir = f"frames_{video_id}"
         Path(frames_dir).mkdir(exist_ok=True)
 
-        # Download video (using your working yt-dlp binary)
-        subprocess.run([
-            './yt-dlp_macos',
-            '--no-check-certificate',
-            '-f', 'bestvideo+bestaudio/best',
-            '--merge-output-format', 'mp4',
-            '--remux-video', 'mp4',
-            video_url,
-            '-o', mp4_path
-        ], check=True)
-
-        # Extract frames every 10 seconds
-        subprocess.run([
-            'ffmpeg', '-i', mp4_path,
-            '-vf', 'fps=1/10',
-            f'{frames_dir}/frame_%04d.png'
-        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        # Transcribe audio
-        whisper_model = whisper.load_model("base")
-        result = whisper_model.transcribe(mp4_path, verbose=False)
-
-        # Write transcript
-        with open(transcript_path, "w") as f:
-            for seg in result['segments']:
-                f.write(f"[{seg['start']:.1f}-{seg['end']:.1f}s]: {seg['text'].strip()}\n")
-
-        # Chunk audio transcript
-        loader = TextLoader(transcript_path)
-        docs = loader.load()
-        splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=20)
-        audio_chunks = splitter.split_documents(docs)
-
-        # Process frames with EasyOCR
-        frame_files = sorted(Path(frames_dir).glob("frame_*.png"))
-        visual_chunks = []
-
-        for i, frame_path in enumerate(frame_files):
-            timestamp = i * 10  # seconds
-
-            # OCR
-            ocr_result = ocr_reader.readtext(str(frame_path))
-            ocr_text = " ".join([text for _, text, _ in ocr_result])  # Extract all detected text
-
-            full_visual_text = f"[Frame at {timestamp}s]\nOCR text: {ocr_text}"
-
-            # Embed
-            emb = ollama.embeddings(model='nomic-embed-text', prompt=full_visual_text)['embedding']
-
-            visual_chunks.append({
-                'chunk_text': full_visual_text,
-                'embedding': emb,
-                'image_path': str(frame_path),
-                'timestamp_start': timestamp,
-                'timestamp_end': timestamp + 10
-            })
-
-        # Store in DB
-        with conn.cursor() as cur:
-            # Audio chunks
-            for chunk in audio_chunks:
-                emb = ollama.embeddings(model='nomic-embed-text', prompt=chunk.page_content)['embedding']
-                cur.execute("""
-                    INSERT INTO video_chunks (video_url, video_description, chunk_type, chunk_text, embedding, timestamp_start, timestamp_end)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """, (video_url, user_description, 'audio', chunk.page_content, emb, None, None))
-
-            # Visual chunks (OCR only)
-            for v_chunk in visual_chunks:
-                cur.execute("""
-                    INSERT INTO video_chunks (video_url, video_description, chunk_type, chunk_text, embedding, image_path, timestamp_start, timestamp_end)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    video_url, user_description, 'visual', v_chunk['chunk_text'], v_chunk['embedding'],
-                    v_chunk['image_path'], v_chunk['timestamp_start'], v_chunk['timestamp_end']
-                ))
-
-            conn.commit()
-
-        # Cleanup
-        shutil.rmtree(frames_dir)
-        os.remove(mp4_path)
-        os.remove(transcript_path)
+        try:
+            # Stream the download (using your working yt-dlp binary) straight into ffmpeg,
+            # which writes a frame every 10 seconds and pipes back 16kHz mono audio for Whisper.
+            # yt-dlp muxes onto stdout with ffmpeg; mkv is used because an mp4 can't be read from a pipe.
+            yt_dlp_proc = subprocess.Popen([
+                './yt-dlp_macos',
+                '--no-check-certificate',
+                '-f', 'bestvideo+bestaudio/best',
+                '--merge-output-format', 'mkv',
+                video_url,
+                '-o', '-'
+            ], stdout=subprocess.PIPE)
+            ffmpeg_proc = subprocess.Popen([
+                'ffmpeg', '-i', 'pipe:0',
+                '-map', '0:v:0', '-vf', 'fps=1/10', f'{frames_dir}/frame_%04d.png',
+                '-map', '0:a:0', '-ar', str(WHISPER_SAMPLE_RATE), '-ac', '1', '-f', 'f32le', 'pipe:1'
+            ], stdin=yt_dlp_proc.stdout, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            yt_dlp_proc.stdout.close()  # Let yt-dlp see a broken pipe if ffmpeg exits early
+
+            audio_bytes, _ = ffmpeg_proc.communicate()
+            if ffmpeg_proc.returncode != 0:
+                # A failed download (bad URL, network error) ends ffmpeg's input early, so
+                # report yt-dlp if it has already exited non-zero
+                if yt_dlp_proc.poll() not in (None, 0):
+                    raise subprocess.CalledProcessError(yt_dlp_proc.returncode, yt_dlp_proc.args)
+                # Otherwise ffmpeg failed on its own and yt-dlp is stuck on the broken pipe
+                yt_dlp_proc.kill()
+                yt_dlp_proc.wait()
+                raise subprocess.CalledProcessError(ffmpeg_proc.returncode, ffmpeg_proc.args)
+            if yt_dlp_proc.wait() != 0:
+                raise subprocess.CalledProcessError(yt_dlp_proc.returncode, yt_dlp_proc.args)
+
+            # Transcribe audio
+            audio = np.frombuffer(audio_bytes, dtype=np.float32)
+            segments, _ = whisper_model.transcribe(audio, vad_filter=True)
+
+            # Build and chunk the transcript in memory
+            transcript = "".join(f"[{seg.start:.1f}-{seg.end:.1f}s]: {seg.text.strip()}\n" for seg in segments)
+            splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=20)
+            audio_texts = splitter.split_text(transcript)
+
+            # Process frames with EasyOCR
+            frame_files = sorted(Path(frames_dir).glob("frame_*.png"))
+
+            # Skip near-duplicate frames (e.g. a static slide) by perceptual hash; a skipped
+            # frame extends the time span of the last kept one instead of getting its own chunk
+            kept_frames, visual_starts, visual_ends = [], [], []
+            last_hash = None
+            for i, frame_path in enumerate(frame_files):
+                timestamp = i * 10  # seconds
+                with Image.open(frame_path) as frame:
+                    frame_hash = imagehash.phash(frame)
+                if last_hash is not None and frame_hash - last_hash < FRAME_HASH_THRESHOLD:
+                    visual_ends[-1] = timestamp + 10
+                    continue
+                last_hash = frame_hash
+                kept_frames.append(str(frame_path))
+                visual_starts.append(timestamp)
+                visual_ends.append(timestamp + 10)
+
+            # OCR frames in groups; all frames share one resolution so EasyOCR can batch them
+            ocr_size = {}
+            if kept_frames:
+                with Image.open(kept_frames[0]) as frame:
+                    width, height = frame.size
+                if height > OCR_MAX_HEIGHT:
+                    ocr_size = {'n_width': round(width * OCR_MAX_HEIGHT / height), 'n_height': OCR_MAX_HEIGHT}
+            ocr_results = []
+            for start in range(0, len(kept_frames), OCR_GROUP_SIZE):
+                group = kept_frames[start:start + OCR_GROUP_SIZE]
+                ocr_results.extend(ocr_reader.readtext_batched(group, batch_size=OCR_BATCH_SIZE, **ocr_size))
+
+            # Visual chunks as parallel lists, one entry per kept frame
+            visual_texts = []
+            for timestamp, ocr_result in zip(visual_starts, ocr_results):
+                ocr_text = " ".join([text for _, text, _ in ocr_result])  # Extract all detected text
+                visual_texts.append(f"[Frame at {timestamp}s]\nOCR text: {ocr_text}")
+
+            # Embed all audio and visual chunks in batched requests
+            audio_embs = embed_texts(audio_texts)
+            visual_embs = embed_texts(visual_texts)
+            prune_embedding_cache()
+
+            rows = chain(
+                zip(repeat(video_url), repeat(user_description), repeat('audio'), audio_texts, audio_embs,
+                    repeat(None), repeat(None), repeat(None)),
+                zip(repeat(video_url), repeat(user_description), repeat('visual'), visual_texts, visual_embs,
+                    kept_frames, visual_starts, visual_ends)
+            )
+
+            # Store in DB
+            with db_connection() as conn, conn.cursor() as cur:
+                copy_chunks(cur, rows)
+                conn.commit()
+        finally:
+            # Cleanup, also when a step above fails
+            shutil.rmtree(frames_dir, ignore_errors=True)
 
         return {
             "status": "success",
             "video_url": video_url,
             "video_description": user_description,
-            "audio_chunks": len(audio_chunks),
-            "visual_chunks": len(frame_files),
+            "audio_chunks": len(audio_texts),
+            "visual_chunks": len(visual_texts),
             "message": "Video ingested with audio transcript and OCR from frames!"
         }
 
@@ -185,30 +444,15 @@ async def ingest_video(data: VideoURL):
         raise HTTPException(status_code=500, detail=f"Ingestion failed: {str(e)}")
 
 @app.post("/query")
-async def query_rag(data: Query):
+def query_rag(data: Query):
     try:
-        q_emb = ollama.embeddings(model='nomic-embed-text', prompt=data.question)['embedding']
+        q_emb = embed_question(EMBED_MODEL, data.question)
 
-        with conn.cursor() as cur:
-            # Top-k audio chunks
-            cur.execute("""
-                SELECT chunk_text
-                FROM video_chunks
-                WHERE video_url = %s AND chunk_type = 'audio'
-                ORDER BY embedding <=> %s::vector
-                LIMIT %s
-            """, (data.video_url, q_emb, data.top_k))
-            audio_results = [row[0] for row in cur.fetchall()]
-
-            # Top-k visual chunks (OCR text)
-            cur.execute("""
-                SELECT chunk_text, image_path
-                FROM video_chunks
-                WHERE video_url = %s AND chunk_type = 'visual'
-                ORDER BY embedding <=> %s::vector
-                LIMIT %s
-            """, (data.video_url, q_emb, data.top_k))
-            visual_results = cur.fetchall()
+        with db_connection() as conn, conn.cursor() as cur:
+            execute_prepared(cur, 'chunk_search', (data.video_url, q_emb, data.top_k))
+            rows = cur.fetchall()
+            audio_results = [text for chunk_type, text, _ in rows if chunk_type == 'audio']
+            visual_results = [(text, img_path) for chunk_type, text, img_path in rows if chunk_type == 'visual']
 
         # Combine context
         context_parts = [f"[Audio]: {text}" for text in audio_results]
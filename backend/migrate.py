@@ -0,0 +1,83 @@
+# migrate.py - One-off schema migration for the embedding cache and its TTL index, halfvec embeddings and
+# the chunk lookup index. Run once before starting (or after upgrading) the API:
+#   python migrate.py
+
+import json
+import psycopg2 as pg
+
+EMBED_DIM = 768
+# Arbitrary key so concurrent runs of this script wait for each other
+MIGRATION_LOCK_ID = 7368201
+
+# Load database config
+config_file_path = './config.json'
+try:
+    with open(config_file_path, 'r', encoding='utf-8') as file:
+        config_data = json.load(file)
+except (FileNotFoundError, json.JSONDecodeError):
+    config_data = {}
+
+def migrate(conn):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            # Embedding cache keyed by sha256 of the chunk text
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    hash TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    embedding vector NOT NULL,
+                    last_used TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (hash, model)
+                )
+            """)
+            # Lets the TTL prune find stale rows without scanning the whole cache
+            cur.execute("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS embedding_cache_last_used_idx
+                ON embedding_cache (last_used)
+            """)
+
+            # Earlier per chunk_type HNSW indexes; dropped before the type change below,
+            # which their vector opclass couldn't survive
+            for chunk_type in ('audio', 'visual'):
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS video_chunks_{chunk_type}_embedding_idx")
+
+            # Store chunk embeddings as FP16 halfvec to halve storage and bytes read per search.
+            # This rewrites the table, so it blocks writes to video_chunks while it runs.
+            cur.execute("""
+                SELECT format_type(atttypid, atttypmod)
+                FROM pg_attribute
+                WHERE attrelid = 'video_chunks'::regclass AND attname = 'embedding'
+            """)
+            if cur.fetchone()[0] != f'halfvec({EMBED_DIM})':
+                cur.execute(f"""
+                    ALTER TABLE video_chunks
+                    ALTER COLUMN embedding TYPE halfvec({EMBED_DIM}) USING embedding::halfvec({EMBED_DIM})
+                """)
+
+            # /query searches within one video, which is only a few hundred chunks, so an exact
+            # scan over a (video_url, chunk_type) btree beats an ANN index that would apply the
+            # video_url filter after returning ef_search neighbours from every video
+            cur.execute("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS video_chunks_video_url_chunk_type_idx
+                ON video_chunks (video_url, chunk_type)
+            """)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+
+
+if __name__ == '__main__':
+    conn = pg.connect(
+        user=config_data.get('database', {}).get('user'),
+        password=config_data.get('database', {}).get('password'),
+        host=config_data.get('database', {}).get('host', 'localhost'),
+        port=config_data.get('database', {}).get('port', 5432),
+        dbname=config_data.get('database', {}).get('database', 'video_chunks')
+    )
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+    print("Migration complete")